@@ -1,6 +1,21 @@
+import atexit
+import logging
+from logging.handlers import QueueListener
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class BudgetmapperConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'budgetmapper'
+
+    def ready(self):
+        log_queue = getattr(settings, "LOG_QUEUE", None)
+        if log_queue is None:
+            return
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(settings.LOG_FORMAT))
+        listener = QueueListener(log_queue, handler)
+        listener.start()
+        atexit.register(listener.stop)
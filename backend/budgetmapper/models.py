@@ -1,23 +1,29 @@
+import re
+from collections import defaultdict
+from functools import lru_cache
 from io import BufferedIOBase, RawIOBase
 
 import pykakasi
 import shortuuidfield
+import zstandard
 from django.conf import settings
 from django.contrib.postgres.fields import ArrayField
 from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import connection, models, transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.text import slugify
+from polymorphic.managers import PolymorphicManager
 from polymorphic.models import PolymorphicModel
+from polymorphic.query import PolymorphicQuerySet
 from rest_framework.authtoken.models import Token
 
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
-def create_auth_token(sender, instance=None, created=False, **kwargs):
-    if created:
+def create_auth_token(sender, instance=None, created=False, raw=False, **kwargs):
+    if created and not raw:
         Token.objects.create(user=instance)
 
 
@@ -35,11 +41,24 @@ class AutoUpdateCurrentDateTimeField(CurrentDateTimeField):
         return val
 
 
-kks = pykakasi.kakasi()
+@lru_cache(maxsize=1)
+def _kks() -> pykakasi.kakasi:
+    return pykakasi.kakasi()
 
 
+# kakasi leaves names made of these characters as a single word, so slugify alone gives the same slug.
+_plain_ascii_name = re.compile(r"[A-Za-z0-9 _-]+")
+
+
+@lru_cache(maxsize=4096)
 def jp_slugify(name: str) -> str:
-    return slugify("-".join(d["hepburn"] for d in kks.convert(name)))
+    if _plain_ascii_name.fullmatch(name):
+        return slugify(name)
+    return slugify("-".join(d["hepburn"] for d in _kks().convert(name)))
+
+
+def jp_slugify_many(names) -> list:
+    return [jp_slugify(name) for name in names]
 
 
 class JpSlugField(models.SlugField):
@@ -126,6 +145,16 @@ class Government(models.Model):
     created_at = CurrentDateTimeField()
     updated_at = AutoUpdateCurrentDateTimeField()
 
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q(latitude__gte=-90.0) & models.Q(latitude__lte=90.0), name="government_latitude_range"
+            ),
+            models.CheckConstraint(
+                check=models.Q(longitude__gte=0.0) & models.Q(longitude__lte=180.0), name="government_longitude_range"
+            ),
+        ]
+
 
 class ClassificationSystem(models.Model):
     id = PkField()
@@ -141,10 +170,10 @@ class ClassificationSystem(models.Model):
 
     @property
     def leaves(self) -> models.QuerySet:
-        return Classification.objects.filter(
-            ~models.Exists(Classification.objects.filter(classification_system=self, parent=models.OuterRef("pk"))),
-            classification_system=self,
-        )
+        return Classification.objects.filter(classification_system=self, classification__isnull=True)
+
+    def levels(self) -> dict:
+        return Classification.fetch_levels([self.id])
 
     def __iterate_classifications_sub(self, buf):
         is_leaf = True
@@ -171,10 +200,33 @@ class Classification(models.Model):
 
     @property
     def level(self) -> int:
+        if hasattr(self, "_cached_level"):
+            return self._cached_level
         if self.parent is None:
             return 0
         return self.parent.level + 1
 
+    @classmethod
+    def fetch_levels(cls, classification_system_ids) -> dict:
+        table = cls._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"WITH RECURSIVE t(id, lvl) AS ("
+                f"SELECT id, 0 FROM {table} WHERE parent_id IS NULL AND classification_system_id = ANY(%s) "
+                f"UNION ALL SELECT c.id, t.lvl + 1 FROM {table} c JOIN t ON c.parent_id = t.id"
+                f") SELECT id, lvl FROM t",
+                [list(classification_system_ids)],
+            )
+            return dict(cursor.fetchall())
+
+    @classmethod
+    def annotate_levels(cls, qs) -> list:
+        items = list(qs)
+        levels = cls.fetch_levels({d.classification_system_id for d in items})
+        for d in items:
+            d._cached_level = levels[d.id]
+        return items
+
     def clean(self) -> None:
         if self.parent is not None:
             if self.parent.classification_system != self.classification_system:
@@ -202,21 +254,59 @@ class Budget(models.Model):
     updated_at = AutoUpdateCurrentDateTimeField()
 
     def get_value_of(self, classification: Classification) -> float:
-        if self.classification_system != classification.classification_system:
+        if self.classification_system_id != classification.classification_system_id:
             raise ValueError
-        try:
-            val = BudgetItemBase.objects.get(budget=self, classification=classification)
-            return val.value
-        except BudgetItemBase.DoesNotExist:
-            return sum(self.get_value_of(c) for c in Classification.objects.filter(parent=classification))
+        return self.compute_values(root_ids=[classification.id])[classification.id]
+
+    def compute_values(self, root_ids=None) -> dict:
+        children = defaultdict(list)
+        for cid, pid in Classification.objects.filter(
+            classification_system_id=self.classification_system_id
+        ).values_list("id", "parent_id"):
+            children[pid].append(cid)
+        subtree_ids = []
+        stack = list(children[None] if root_ids is None else root_ids)
+        while stack:
+            cid = stack.pop()
+            subtree_ids.append(cid)
+            stack.extend(children[cid])
+
+        atomic_qs = AtomicBudgetItem.objects.filter(budget=self)
+        mapped_qs = MappedBudgetItem.objects.filter(budget=self)
+        if root_ids is not None:
+            atomic_qs = atomic_qs.filter(classification_id__in=subtree_ids)
+            mapped_qs = mapped_qs.filter(classification_id__in=subtree_ids)
+        items = dict(atomic_qs.values_list("classification_id", "amount"))
+        for d in mapped_qs.with_values():
+            items[d.classification_id] = d.value
+
+        values = {}
+        for cid in reversed(subtree_ids):
+            if cid in items:
+                values[cid] = float(items[cid])
+            else:
+                values[cid] = sum(values[c] for c in children[cid])
+        return values
+
+    def subtree_sum(self, classification_id: str) -> float:
+        table = Classification._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"WITH RECURSIVE sub(id) AS ("
+                f"SELECT id FROM {table} WHERE id = %s "
+                f"UNION ALL SELECT c.id FROM {table} c JOIN sub ON c.parent_id = sub.id"
+                f") SELECT COALESCE(SUM(a.amount), 0) FROM {BudgetItemBase._meta.db_table} b "
+                f"JOIN {AtomicBudgetItem._meta.db_table} a ON a.budgetitembase_ptr_id = b.id "
+                f"JOIN sub ON b.classification_id = sub.id WHERE b.budget_id = %s",
+                [classification_id, self.id],
+            )
+            return float(cursor.fetchone()[0])
 
     def iterate_items(self):
+        items = {d.classification_id: d for d in AtomicBudgetItem.objects.filter(budget=self).non_polymorphic()}
+        items.update((d.classification_id, d) for d in MappedBudgetItem.objects.filter(budget=self).with_values())
         for cl in self.classification_system.iterate_classifications():
-            try:
-                val = BudgetItemBase.objects.get(budget=self, classification=cl[-1])
-                yield {"classifications": cl, "budget_item": val}
-            except BudgetItemBase.DoesNotExist:
-                yield {"classifications": cl, "budget_item": None}
+            yield {"classifications": cl, "budget_item": items.get(cl[-1].id)}
 
     class Meta:
         indexes = [
@@ -233,6 +323,9 @@ class BudgetItemBase(PolymorphicModel):
 
     @property
     def value(self) -> float:
+        return self.get_value()
+
+    def get_value(self, cache: dict = None) -> float:
         raise NotImplementedError
 
     class Meta:
@@ -251,18 +344,68 @@ class BudgetItemBase(PolymorphicModel):
 class AtomicBudgetItem(BudgetItemBase):
     amount = BudgetAmountField()
 
-    @property
-    def value(self) -> float:
+    def get_value(self, cache: dict = None) -> float:
         return float(self.amount)
 
+    # budget and classification live on the parent table, whose (budget, classification) unique index serves
+    # lookups; amount is fetched through this table's primary key, so no extra index is declared here.
+
+
+def _mapped_classifications_prefetch() -> models.Prefetch:
+    return models.Prefetch(
+        "mapped_classifications",
+        queryset=Classification.objects.only("id", "name", "code", "classification_system"),
+    )
+
+
+def prefetch_mapped_budget_item_relations(items) -> None:
+    models.prefetch_related_objects(
+        [d for d in items if isinstance(d, MappedBudgetItem)], "mapped_budget", _mapped_classifications_prefetch()
+    )
+
+
+def resolve_mapped_budget_item_values(items) -> None:
+    mapped = [d for d in items if isinstance(d, MappedBudgetItem)]
+    prefetch_mapped_budget_item_relations(mapped)
+    caches = {}
+    for d in mapped:
+        if d.mapped_budget_id not in caches:
+            caches[d.mapped_budget_id] = d.mapped_budget.compute_values()
+        d._cached_value = d.get_value(cache=caches[d.mapped_budget_id])
+
+
+
+class MappedBudgetItemQuerySet(PolymorphicQuerySet):
+    def with_related(self) -> "MappedBudgetItemQuerySet":
+        return self.select_related("mapped_budget", "budget", "classification").prefetch_related(
+            _mapped_classifications_prefetch()
+        )
+
+    def with_values(self) -> list:
+        items = list(self.select_related("mapped_budget").prefetch_related(_mapped_classifications_prefetch()))
+        resolve_mapped_budget_item_values(items)
+        return items
+
 
 class MappedBudgetItem(BudgetItemBase):
     mapped_budget = models.ForeignKey(Budget, db_index=True, on_delete=models.CASCADE, null=False)
     mapped_classifications = models.ManyToManyField(Classification, related_name="mapping_classifications")
 
+    objects = PolymorphicManager.from_queryset(MappedBudgetItemQuerySet)()
+
     @property
     def value(self) -> float:
-        return sum(self.mapped_budget.get_value_of(c) for c in self.mapped_classifications.all())
+        if hasattr(self, "_cached_value"):
+            return self._cached_value
+        return self.get_value()
+
+    def get_value(self, cache: dict = None) -> float:
+        classifications = self.mapped_classifications.all()
+        if any(c.classification_system_id != self.mapped_budget.classification_system_id for c in classifications):
+            raise ValueError
+        if cache is None:
+            cache = self.mapped_budget.compute_values(root_ids=[c.id for c in classifications])
+        return sum(cache[c.id] for c in classifications)
 
 
 class Blob(models.Model):
@@ -271,50 +414,73 @@ class Blob(models.Model):
     created_at = CurrentDateTimeField()
     updated_at = AutoUpdateCurrentDateTimeField()
 
+    # Large chunks keep the number of rows (and round trips) per blob small. PostgreSQL TOASTs bytea
+    # values anyway, so big bodies do not hurt heap density; the cost is memory per chunk and batch.
     @classmethod
-    def write(cls, data: RawIOBase, name: str = None, chunk_size: int = 65536) -> None:
-        instance = cls(name=name)
-        instance.save()
-        idx = 0
-        while True:
-            buf = data.read(chunk_size)
-            if len(buf) == 0:
-                break
-            BlobChunk(blob=instance, index=idx, body=buf).save()
-            idx += 1
+    def write(
+        cls, data: RawIOBase, name: str = None, chunk_size: int = 4 << 20, batch_size: int = 16, compress: bool = True
+    ) -> None:
+        compressor = zstandard.ZstdCompressor(level=3) if compress else None
+        with transaction.atomic():
+            instance = cls(name=name)
+            instance.save()
+            idx = 0
+            batch = []
+            while True:
+                buf = data.read(chunk_size)
+                if len(buf) == 0:
+                    break
+                if compress:
+                    buf = compressor.compress(buf)
+                batch.append(BlobChunk(blob=instance, index=idx, body=buf, compressed=compress))
+                idx += 1
+                if len(batch) >= batch_size:
+                    BlobChunk.objects.bulk_create(batch, batch_size=batch_size)
+                    batch = []
+            if len(batch) > 0:
+                BlobChunk.objects.bulk_create(batch, batch_size=batch_size)
         return instance
 
 
 class BlobChunk(models.Model):
-    id = PkField()
     blob = models.ForeignKey(Blob, on_delete=models.CASCADE, db_index=False, null=False)
     index = models.PositiveIntegerField(db_index=False)
     body = models.BinaryField(db_index=False)
+    compressed = models.BooleanField(default=False)
 
     class Meta:
+        # The unique index on (blob, index) also serves BlobReader's filter(blob=...).order_by("index"),
+        # so blob and index need no separate indexes.
         unique_together = ("blob", "index")
 
 
 class BlobReader(BufferedIOBase):
-    def __init__(self, blob: Blob):
-        self._fp = BlobChunk.objects.filter(blob=blob).order_by("index")
-        self._buffer = b''
-        self._gen = self._next()
+    _min_readahead = 4 << 20
+    _compact_threshold = 4 << 20
 
-    def _next(self) -> BlobChunk:
-        for d in self._fp:
-            yield d
+    def __init__(self, blob: Blob):
+        self._fp = (
+            BlobChunk.objects.filter(blob=blob).order_by("index").only("body", "compressed").iterator(chunk_size=8)
+        )
+        self._decompressor = zstandard.ZstdDecompressor()
+        self._buffer = bytearray()
+        self._pos = 0
 
     def read(self, size: int = -1) -> bytes:
-        while size == -1 or len(self._buffer) < size:
+        while size < 0 or len(self._buffer) - self._pos < max(size, self._min_readahead):
             try:
-                self._buffer += next(self._gen).body
+                chunk = next(self._fp)
             except StopIteration:
                 break
-        if size >= 0:
-            retval = self._buffer[:size]
-            self._buffer = self._buffer[size:]
-        else:
-            retval = self._buffer
-            self._buffer = b""
+            if chunk.compressed:
+                self._buffer.extend(self._decompressor.decompress(chunk.body))
+            else:
+                self._buffer.extend(chunk.body)
+        end = len(self._buffer) if size < 0 else min(self._pos + size, len(self._buffer))
+        with memoryview(self._buffer) as view:
+            retval = bytes(view[self._pos : end])
+        self._pos = end
+        if self._pos > self._compact_threshold or self._pos == len(self._buffer):
+            del self._buffer[: self._pos]
+            self._pos = 0
         return retval
@@ -108,9 +108,9 @@ class BudgetDetailSerializer(serializers.ModelSerializer):
         )
 
     def get_items(self, obj):
-        return BudgetItemSerializer(
-            models.BudgetItemBase.objects.filter(budget=obj).prefetch_related("classification"), many=True
-        ).data
+        items = list(models.BudgetItemBase.objects.filter(budget=obj).prefetch_related("classification"))
+        models.resolve_mapped_budget_item_values(items)
+        return BudgetItemSerializer(items, many=True).data
 
 
 class AtomicBudgetItemCreateUpdateSerializer(serializers.ModelSerializer):
@@ -136,6 +136,13 @@ class MappedBudgetItemSerializer(serializers.ModelSerializer):
         )
 
 
+class PolymorphicBudgetItemSerializer(BudgetItemSerializer):
+    def to_representation(self, instance):
+        if isinstance(instance, models.MappedBudgetItem):
+            return MappedBudgetItemSerializer(instance=instance, context=self.context).data
+        return super().to_representation(instance)
+
+
 class MappedBudgetItemDetailSerializer(serializers.ModelSerializer):
     classification = ClassificationSummarySerializer()
     mapped_classifications = ClassificationSummarySerializer(many=True)
@@ -178,10 +185,13 @@ class BudgetNodeSerializer(serializers.ModelSerializer):
         is_leaf = True
         children = []
         for c in instance.direct_children:
-            children.append(BudgetNodeSerializer(instance=c, context={"budget": self.context["budget"]}).data)
+            children.append(BudgetNodeSerializer(instance=c, context=self.context).data)
             is_leaf = False
         if is_leaf:
-            amount = self.context["budget"].get_value_of(instance)
+            if "values" in self.context:
+                amount = self.context["values"][instance.id]
+            else:
+                amount = self.context["budget"].get_value_of(instance)
             children = None
         else:
             amount = sum((c["amount"] for c in children))
@@ -197,4 +207,5 @@ class WdmmgSerializer(serializers.ModelSerializer):
         fields = ("id", "name", "subtitle", "slug", "year", "created_at", "updated_at", "government", "budgets")
 
     def get_budgets(self, obj: models.Budget):
-        return [BudgetNodeSerializer(instance=c, context={"budget": obj}).data for c in obj.classification_system.roots]
+        context = {"budget": obj, "values": obj.compute_values()}
+        return [BudgetNodeSerializer(instance=c, context=context).data for c in obj.classification_system.roots]
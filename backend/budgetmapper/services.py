@@ -0,0 +1,10 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+
+
+def bulk_create_users(users) -> list:
+    with transaction.atomic():
+        users = get_user_model().objects.bulk_create(users)
+        Token.objects.bulk_create([Token(user=u, key=Token.generate_key()) for u in users])
+    return users
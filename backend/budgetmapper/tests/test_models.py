@@ -2,10 +2,14 @@ import doctest
 from collections.abc import Iterator
 from unittest.mock import MagicMock, patch
 
+import pykakasi
+import zstandard
 from budgetmapper import models
 from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.db.utils import IntegrityError
 from django.test import TestCase, TransactionTestCase
+from django.utils.text import slugify
 
 from . import factories
 
@@ -15,6 +19,31 @@ def load_tests(loader, tests, ignore):
     return tests
 
 
+class JpSlugifyTest(TestCase):
+    def test_jp_slugify(self) -> None:
+        models.jp_slugify.cache_clear()
+        self.assertEqual(models.jp_slugify("まほろ市 2101 年度予算"), "mahoro-shi-2101-nendo-yosan")
+        self.assertEqual(models.jp_slugify("まほろ市 2101 年度予算"), "mahoro-shi-2101-nendo-yosan")
+        self.assertEqual(models.jp_slugify.cache_info().hits, 1)
+
+    @patch("budgetmapper.models._kks")
+    def test_jp_slugify_ascii_does_not_use_kakasi(self, kks: MagicMock) -> None:
+        self.assertEqual(models.jp_slugify("Mahoro City 2101"), "mahoro-city-2101")
+        kks.assert_not_called()
+
+    def test_jp_slugify_punctuated_ascii_matches_kakasi(self) -> None:
+        kks = pykakasi.kakasi()
+        for name in ["R3.4", "Tokyo, 2021!", "(a)b", "x.y", "a/b", "Mahoro City_2101-a"]:
+            expected = slugify("-".join(d["hepburn"] for d in kks.convert(name)))
+            self.assertEqual(models.jp_slugify(name), expected)
+        self.assertNotEqual(models.jp_slugify("R3.4"), models.jp_slugify("R34"))
+
+    def test_jp_slugify_many(self) -> None:
+        self.assertEqual(
+            models.jp_slugify_many(["まほろ市", "Mahoro City", "まほろ市"]), ["mahoro-shi", "mahoro-city", "mahoro-shi"]
+        )
+
+
 class GovernmentTest(TestCase):
     def test_government_has_slug(self) -> None:
         sut = models.Government(name="まほろ市", slug="mahoro-city")
@@ -34,6 +63,15 @@ class GovernmentTest(TestCase):
         sut.save()
         self.assertEqual(sut.id, "ab12345678901234567890")
 
+    def test_government_coordinates_are_checked_by_db(self) -> None:
+        models.Government.objects.bulk_create([models.Government(name="まほろ市", slug="mahoro", latitude=35.6)])
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                models.Government.objects.bulk_create([models.Government(name="まほろ市", slug="a", latitude=91.0)])
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                models.Government.objects.bulk_create([models.Government(name="まほろ市", slug="b", longitude=-1.0)])
+
 
 class ClassificationSystemTest(TestCase):
     @patch("budgetmapper.models.shortuuidfield.ShortUUIDField.get_default", return_value="ab12345678901234567890")
@@ -53,6 +91,18 @@ class ClassificationSystemTest(TestCase):
         sut.save()
         self.assertEqual(sut.slug, "special-slug")
 
+    def test_leaves(self) -> None:
+        cs = factories.ClassificationSystemFactory()
+        cl0 = factories.ClassificationFactory(classification_system=cs)
+        cl00 = factories.ClassificationFactory(classification_system=cs, parent=cl0)
+        cl01 = factories.ClassificationFactory(classification_system=cs, parent=cl0)
+        cl010 = factories.ClassificationFactory(classification_system=cs, parent=cl01)
+        cl1 = factories.ClassificationFactory(classification_system=cs)
+        factories.ClassificationFactory()
+
+        self.assertEqual(set(cs.leaves), {cl00, cl010, cl1})
+        self.assertIn("LEFT OUTER JOIN", str(cs.leaves.query))
+
     def test_iterate_classifications(self) -> None:
         cs = factories.ClassificationSystemFactory()
         cl0 = factories.ClassificationFactory(classification_system=cs, code="1")
@@ -102,6 +152,21 @@ class ClassificationTest(TransactionTestCase):
         self.assertEqual(sut.parent, root)
         self.assertEqual(sut.level, 1)
 
+    def test_annotate_levels(self) -> None:
+        cs = factories.ClassificationSystemFactory()
+        cl0 = factories.ClassificationFactory(classification_system=cs)
+        cl00 = factories.ClassificationFactory(classification_system=cs, parent=cl0)
+        cl000 = factories.ClassificationFactory(classification_system=cs, parent=cl00)
+        cl1 = factories.ClassificationFactory(classification_system=cs)
+        other = factories.ClassificationFactory()
+
+        self.assertEqual(cs.levels(), {cl0.id: 0, cl00.id: 1, cl000.id: 2, cl1.id: 0})
+        with self.assertNumQueries(2):
+            actual = models.Classification.annotate_levels(
+                models.Classification.objects.filter(id__in=[cl000.id, cl1.id, other.id]).order_by("item_order")
+            )
+            self.assertEqual([d.level for d in actual], [2, 0, 0])
+
     def test_cs_coincides(self) -> None:
         root = factories.ClassificationFactory()
         sut = models.Classification(
@@ -205,6 +270,23 @@ class BudgetTest(TestCase):
         for e, a in zip(expected, actual):
             self.assertEqual(a, e)
 
+    def test_iterate_items_with_mapped_item(self) -> None:
+        orig_bud = factories.BudgetFactory()
+        orig_cl = factories.ClassificationFactory(classification_system=orig_bud.classification_system)
+        atm = factories.AtomicBudgetItemFactory(budget=orig_bud, classification=orig_cl)
+        cs = factories.ClassificationSystemFactory()
+        bud = factories.BudgetFactory(classification_system=cs)
+        cl0 = factories.ClassificationFactory(classification_system=cs)
+        cl1 = factories.ClassificationFactory(classification_system=cs)
+        abi0 = factories.AtomicBudgetItemFactory(budget=bud, classification=cl0)
+        mbi1 = models.MappedBudgetItem(budget=bud, classification=cl1, mapped_budget=orig_bud)
+        mbi1.save()
+        mbi1.mapped_classifications.set([orig_cl])
+
+        actual = list(bud.iterate_items())
+        self.assertEqual([d["budget_item"] for d in actual], [abi0, mbi1])
+        self.assertEqual([d["budget_item"].value for d in actual], [abi0.value, atm.value])
+
 
 class AtomicBudgetItemTestCase(TestCase):
     def test_atomic_budget_item_default(self) -> None:
@@ -262,6 +344,63 @@ class MappedBudgetItemTestCase(TestCase):
         self.assertEqual(sut.classification, cl)
         self.assertEqual(bud.get_value_of(cl), sum(atm.value for atm in atms))
 
+    def test_mapped_classifications_must_belong_to_mapped_budget(self) -> None:
+        orig_bud = factories.BudgetFactory()
+        foreign_cl = factories.ClassificationFactory()
+        factories.AtomicBudgetItemFactory(classification=foreign_cl)
+        bud = factories.BudgetFactory()
+        cl = factories.ClassificationFactory(classification_system=bud.classification_system)
+        sut = models.MappedBudgetItem(budget=bud, classification=cl, mapped_budget=orig_bud)
+        sut.save()
+        sut.mapped_classifications.set([foreign_cl])
+
+        with self.assertRaises(ValueError):
+            sut.value
+        with self.assertRaises(ValueError):
+            models.MappedBudgetItem.objects.filter(budget=bud).with_values()
+        with self.assertRaises(ValueError):
+            bud.get_value_of(cl)
+
+    def test_with_values(self) -> None:
+        orig_bud = factories.BudgetFactory()
+        atms = [
+            factories.AtomicBudgetItemFactory(
+                classification=factories.ClassificationFactory(classification_system=orig_bud.classification_system),
+                budget=orig_bud,
+            )
+            for _ in range(10)
+        ]
+        bud = factories.BudgetFactory()
+        expected = {}
+        for i in range(5):
+            cl = factories.ClassificationFactory(classification_system=bud.classification_system)
+            mbi = models.MappedBudgetItem(budget=bud, classification=cl, mapped_budget=orig_bud)
+            mbi.save()
+            mbi.mapped_classifications.set([atm.classification for atm in atms[i * 2 : i * 2 + 2]])
+            expected[mbi.id] = sum(atm.value for atm in atms[i * 2 : i * 2 + 2])
+
+        with self.assertNumQueries(5):
+            actual = {d.id: d.value for d in models.MappedBudgetItem.objects.filter(budget=bud).with_values()}
+        self.assertEqual(actual, expected)
+
+    def test_with_related(self) -> None:
+        orig_bud = factories.BudgetFactory()
+        bud = factories.BudgetFactory()
+        for _ in range(5):
+            factories.MappedBudgetItemFactory(
+                budget=bud,
+                mapped_budget=orig_bud,
+                classification=factories.ClassificationFactory(classification_system=bud.classification_system),
+            )
+
+        with self.assertNumQueries(2):
+            items = list(models.MappedBudgetItem.objects.filter(budget=bud).with_related())
+            for d in items:
+                self.assertEqual(d.budget, bud)
+                self.assertEqual(d.mapped_budget, orig_bud)
+                self.assertIsNotNone(d.classification.name)
+                self.assertGreater(len([(c.name, c.code) for c in d.mapped_classifications.all()]), 0)
+
 
 class ComplexBudgetItemTestCase(TestCase):
     def test_get_value_of_tree_nodes(self) -> None:
@@ -287,6 +426,59 @@ class ComplexBudgetItemTestCase(TestCase):
         self.assertEqual(bud.get_value_of(cl1), abi10.value)
         self.assertEqual(bud.get_value_of(cl10), abi10.value)
 
+    def test_compute_values(self) -> None:
+        cs = factories.ClassificationSystemFactory()
+        bud = factories.BudgetFactory(classification_system=cs)
+        cl0 = factories.ClassificationFactory(classification_system=cs)
+        cl00 = factories.ClassificationFactory(classification_system=cs, parent=cl0)
+        cl000 = factories.ClassificationFactory(classification_system=cs, parent=cl00)
+        cl001 = factories.ClassificationFactory(classification_system=cs, parent=cl00)
+        cl01 = factories.ClassificationFactory(classification_system=cs, parent=cl0)
+        cl1 = factories.ClassificationFactory(classification_system=cs)
+        cl10 = factories.ClassificationFactory(classification_system=cs, parent=cl1)
+        cl11 = factories.ClassificationFactory(classification_system=cs, parent=cl1)
+
+        abi000 = factories.AtomicBudgetItemFactory(budget=bud, classification=cl000)
+        abi001 = factories.AtomicBudgetItemFactory(budget=bud, classification=cl001)
+        abi01 = factories.AtomicBudgetItemFactory(budget=bud, classification=cl01)
+        abi10 = factories.AtomicBudgetItemFactory(budget=bud, classification=cl10)
+
+        expected = {
+            cl0.id: abi000.value + abi001.value + abi01.value,
+            cl00.id: abi000.value + abi001.value,
+            cl000.id: abi000.value,
+            cl001.id: abi001.value,
+            cl01.id: abi01.value,
+            cl1.id: abi10.value,
+            cl10.id: abi10.value,
+            cl11.id: 0,
+        }
+        self.assertEqual(bud.compute_values(), expected)
+        self.assertEqual(
+            bud.compute_values(root_ids=[cl00.id]),
+            {cl00.id: expected[cl00.id], cl000.id: expected[cl000.id], cl001.id: expected[cl001.id]},
+        )
+        with self.assertNumQueries(3):
+            self.assertEqual(bud.get_value_of(cl0), expected[cl0.id])
+
+    def test_subtree_sum(self) -> None:
+        cs = factories.ClassificationSystemFactory()
+        bud = factories.BudgetFactory(classification_system=cs)
+        cl0 = factories.ClassificationFactory(classification_system=cs)
+        cl00 = factories.ClassificationFactory(classification_system=cs, parent=cl0)
+        cl000 = factories.ClassificationFactory(classification_system=cs, parent=cl00)
+        cl01 = factories.ClassificationFactory(classification_system=cs, parent=cl0)
+        cl1 = factories.ClassificationFactory(classification_system=cs)
+
+        abi000 = factories.AtomicBudgetItemFactory(budget=bud, classification=cl000)
+        abi01 = factories.AtomicBudgetItemFactory(budget=bud, classification=cl01)
+        factories.AtomicBudgetItemFactory(classification=cl000)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(bud.subtree_sum(cl0.id), abi000.value + abi01.value)
+        self.assertEqual(bud.subtree_sum(cl00.id), abi000.value)
+        self.assertEqual(bud.subtree_sum(cl1.id), 0.0)
+
     def test_get_value_of_mapped_tree_nodes(self) -> None:
         cs0 = factories.ClassificationSystemFactory()
         bud0 = factories.BudgetFactory(classification_system=cs0)
@@ -332,25 +524,25 @@ class ComplexBudgetItemTestCase(TestCase):
 
 
 class BlobTestCase(TestCase):
-    @patch(
-        "budgetmapper.models.shortuuidfield.ShortUUIDField.get_default",
-        side_effect=["ab12345678901234567890", "ab12345678901234567891", "ab12345678901234567892"],
-    )
+    @patch("budgetmapper.models.shortuuidfield.ShortUUIDField.get_default", return_value="ab12345678901234567890")
     def test_blob_write_and_reader(self, _):
         from io import BytesIO
 
         raw_data = BytesIO(b"F" * 65537)
         name = "test"
-        blob = models.Blob.write(raw_data, name=name)
+        blob = models.Blob.write(raw_data, name=name, chunk_size=65536)
         self.assertEqual(blob.id, "ab12345678901234567890")
         self.assertEqual(blob.name, "test")
         c1, c2 = models.BlobChunk.objects.filter(blob=blob).order_by("index")
-        self.assertEqual(c1.id, "ab12345678901234567891")
-        self.assertEqual(bytes(c1.body), b"F" * 65536)
+        self.assertIsInstance(c1.id, int)
+        self.assertTrue(c1.compressed)
+        self.assertEqual(zstandard.ZstdDecompressor().decompress(bytes(c1.body)), b"F" * 65536)
+        self.assertLess(len(c1.body), 65536)
         self.assertEqual(c1.index, 0)
 
-        self.assertEqual(c2.id, "ab12345678901234567892")
-        self.assertEqual(bytes(c2.body), b"F")
+        self.assertGreater(c2.id, c1.id)
+        self.assertTrue(c2.compressed)
+        self.assertEqual(zstandard.ZstdDecompressor().decompress(bytes(c2.body)), b"F")
         self.assertEqual(c2.index, 1)
 
         reader = models.BlobReader(blob)
@@ -360,3 +552,40 @@ class BlobTestCase(TestCase):
         expected = b"F" * 65534
         actual = reader.read()
         self.assertEqual(actual, expected)
+
+    def test_blob_write_in_batches(self):
+        from io import BytesIO
+
+        blob = models.Blob.write(BytesIO(b"ABCDEFG"), name="test", chunk_size=2, batch_size=3, compress=False)
+        actual = [(c.index, bytes(c.body)) for c in models.BlobChunk.objects.filter(blob=blob).order_by("index")]
+        self.assertEqual(actual, [(0, b"AB"), (1, b"CD"), (2, b"EF"), (3, b"G")])
+        self.assertEqual(models.BlobReader(blob).read(), b"ABCDEFG")
+
+    def test_blob_write_default_chunk_size(self):
+        from io import BytesIO
+
+        blob = models.Blob.write(BytesIO(b"F" * 65537), name="test")
+        self.assertEqual(models.BlobChunk.objects.filter(blob=blob).count(), 1)
+
+    def test_blob_reader_reads_across_chunks(self):
+        from io import BytesIO
+
+        raw = bytes(range(256)) * 10
+        blob = models.Blob.write(BytesIO(raw), name="test", chunk_size=100)
+        reader = models.BlobReader(blob)
+        reader._compact_threshold = 64
+        actual = b"".join(iter(lambda: reader.read(37), b""))
+        self.assertEqual(actual, raw)
+        self.assertEqual(reader.read(), b"")
+
+    def test_blob_reader_reads_ahead(self):
+        from io import BytesIO
+
+        raw = bytes(range(256)) * 10
+        blob = models.Blob.write(BytesIO(raw), name="test", chunk_size=100)
+        reader = models.BlobReader(blob)
+        reader._min_readahead = 250
+        self.assertEqual(reader.read(1), raw[:1])
+        self.assertEqual(len(reader._buffer), 300)
+        self.assertEqual(reader.read(1000), raw[1:1001])
+        self.assertEqual(reader.read(), raw[1001:])
@@ -10,6 +10,7 @@ from budgetmapper import models
 from budgetmapper.views import CreatedAtPagination
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
 from django.test import Client, TestCase
 from rest_framework import status
 from rest_framework.test import APITestCase
@@ -656,6 +657,27 @@ class BudgetCrudTestCase(BudgetMapperTestUserAPITestCase):
         actual = res.json()
         self.assertEqual(actual, expected)
 
+    def test_retrieve_with_mapped_items_query_count(self):
+        orig_bud = factories.BudgetFactory()
+        orig_cls = [
+            factories.ClassificationFactory(classification_system=orig_bud.classification_system) for _ in range(10)
+        ]
+        atms = [factories.AtomicBudgetItemFactory(budget=orig_bud, classification=cl) for cl in orig_cls]
+        b = factories.BudgetFactory()
+        expected = {}
+        for i in range(5):
+            cl = factories.ClassificationFactory(classification_system=b.classification_system)
+            mbi = models.MappedBudgetItem(budget=b, classification=cl, mapped_budget=orig_bud)
+            mbi.save()
+            mbi.mapped_classifications.set(orig_cls[i * 2 : i * 2 + 2])
+            expected[mbi.id] = sum(atm.value for atm in atms[i * 2 : i * 2 + 2])
+
+        ContentType.objects.get_for_model(models.BudgetItemBase)
+        with self.assertNumQueries(11):
+            res = self.client.get(f"/api/v1/budgets/{b.id}/", format="json")
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual({d["id"]: d["value"] for d in res.json()["items"]}, expected)
+
     def test_create_requires_authentication(self):
         gov = factories.GovernmentFactory()
         cs = factories.ClassificationSystemFactory()
@@ -993,6 +1015,65 @@ class MappedBudgetItemCrudTestCase(BudgetMapperTestUserAPITestCase):
         actual = res_json["results"]
         self.assertEqual(actual, expected)
 
+    def test_list_query_count_does_not_depend_on_item_count(self):
+        bud0 = factories.BudgetFactory()
+        bud1 = factories.BudgetFactory()
+        for _ in range(8):
+            factories.MappedBudgetItemFactory(
+                budget=bud1,
+                mapped_budget=bud0,
+                classification=factories.ClassificationFactory(classification_system=bud1.classification_system),
+            )
+
+        with self.assertNumQueries(4):
+            res = self.client.get(f"/api/v1/budgets/{bud1.id}/items/", format="json")
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(res.json()["results"]), 8)
+
+    def test_list_mixed_budget(self):
+        bud0 = factories.BudgetFactory()
+        bud1 = factories.BudgetFactory()
+        mbi = factories.MappedBudgetItemFactory(
+            budget=bud1,
+            mapped_budget=bud0,
+            classification=factories.ClassificationFactory(classification_system=bud1.classification_system),
+        )
+        abi = factories.AtomicBudgetItemFactory(
+            budget=bud1,
+            classification=factories.ClassificationFactory(classification_system=bud1.classification_system),
+        )
+
+        res = self.client.get(f"/api/v1/budgets/{bud1.id}/items/", format="json")
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        actual = {d["id"]: d for d in res.json()["results"]}
+        self.assertEqual(set(actual), {mbi.id, abi.id})
+        self.assertEqual(actual[abi.id]["value"], abi.value)
+        self.assertNotIn("mappedBudget", actual[abi.id])
+        self.assertEqual(actual[mbi.id]["mappedBudget"]["id"], bud0.id)
+        self.assertEqual(
+            [c["id"] for c in actual[mbi.id]["mappedClassifications"]],
+            [c.id for c in mbi.mapped_classifications.all()],
+        )
+        self.assertNotIn("value", actual[mbi.id])
+
+    def test_retrieve_atomic_item_in_mixed_budget(self):
+        bud0 = factories.BudgetFactory()
+        bud1 = factories.BudgetFactory()
+        factories.MappedBudgetItemFactory(
+            budget=bud1,
+            mapped_budget=bud0,
+            classification=factories.ClassificationFactory(classification_system=bud1.classification_system),
+        )
+        abi = factories.AtomicBudgetItemFactory(
+            budget=bud1,
+            classification=factories.ClassificationFactory(classification_system=bud1.classification_system),
+        )
+
+        res = self.client.get(f"/api/v1/budgets/{bud1.id}/items/{abi.id}/", format="json")
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.json()["id"], abi.id)
+        self.assertEqual(res.json()["value"], abi.value)
+
     def test_retrieve(self):
         cs0 = factories.ClassificationSystemFactory()
         bud0 = factories.BudgetFactory(classification_system=cs0)
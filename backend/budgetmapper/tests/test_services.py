@@ -0,0 +1,18 @@
+from budgetmapper import services
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from rest_framework.authtoken.models import Token
+
+
+class BulkCreateUsersTestCase(TestCase):
+    def test_bulk_create_users_creates_tokens(self):
+        User = get_user_model()
+        with self.assertNumQueries(4):
+            users = services.bulk_create_users([User(username=f"user{i}") for i in range(10)])
+        self.assertEqual(len(users), 10)
+        self.assertEqual(Token.objects.filter(user__in=users).count(), 10)
+        self.assertEqual(len(set(Token.objects.values_list("key", flat=True))), 10)
+
+    def test_create_user_creates_token(self):
+        user = get_user_model().objects.create(username="testuser")
+        self.assertTrue(Token.objects.filter(user=user).exists())
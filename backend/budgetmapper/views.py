@@ -69,7 +69,9 @@ class BudgetItemViewSet(viewsets.ModelViewSet):
                 return serializers.AtomicBudgetItemCreateUpdateSerializer
             if "mapped_budget" in self.request.data and "mapped_classifications" in self.request.data:
                 return serializers.MappedBudgetItemCreateUpdateSerializer
-        if isinstance(self.get_queryset().first(), models.MappedBudgetItem):
+        if self.action == "list":
+            return serializers.PolymorphicBudgetItemSerializer
+        if self._has_mapped_items():
             if self.action == "retrieve":
                 return serializers.MappedBudgetItemDetailSerializer
             if self.action in {"update", "partial_update"}:
@@ -79,8 +81,26 @@ class BudgetItemViewSet(viewsets.ModelViewSet):
             return serializers.AtomicBudgetItemCreateUpdateSerializer
         return serializers.BudgetItemSerializer
 
+    def _has_mapped_items(self) -> bool:
+        if not hasattr(self, "_mapped_items"):
+            self._mapped_items = models.MappedBudgetItem.objects.filter(budget=self.kwargs["budget_pk"]).exists()
+        return self._mapped_items
+
     def get_queryset(self):
-        return models.BudgetItemBase.objects.filter(budget=self.kwargs["budget_pk"])
+        return models.BudgetItemBase.objects.filter(budget=self.kwargs["budget_pk"]).select_related(
+            "budget", "classification"
+        )
+
+    def get_object(self):
+        obj = super().get_object()
+        self._mapped_items = isinstance(obj, models.MappedBudgetItem)
+        return obj
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None:
+            models.prefetch_mapped_budget_item_relations(page)
+        return page
 
 
 class WdmmgView(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
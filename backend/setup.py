@@ -22,6 +22,7 @@ setup(
         "pykakasi",
         "drf-nested-routers",
         "django-polymorphic",
+        "zstandard",
         "django",
     ],
     extras_require={
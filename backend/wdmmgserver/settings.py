@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
 import os
+import queue
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -101,6 +102,8 @@ DATABASES = {
         'PASSWORD': getenv_or_die('APPLICATION_DATABASE_PASSWORD'),
         'PORT': os.getenv("APPLICATION_DATABASE_PORT", "5432"),
         'HOST': os.getenv('APPLICATION_DATABASE_HOST', "localhost"),
+        'CONN_MAX_AGE': int(os.getenv("APPLICATION_DATABASE_CONN_MAX_AGE", "600")),
+        'CONN_HEALTH_CHECKS': True,
         'TEST': {
             'NAME': f'test_{os.getenv("APPLICATION_DATABASE_DATABASE_NAME", "postgres")}',
         },
@@ -169,18 +172,22 @@ STATICFILES_DIRS = (os.path.join(os.path.dirname(BASE_DIR), 'frontend/dist/'),)
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Records are only enqueued on the logging thread; budgetmapper's AppConfig.ready() starts a QueueListener that
+# formats and writes them to stderr with LOG_FORMAT.
+LOG_QUEUE = queue.Queue(-1)
+LOG_FORMAT = '%(levelname)s %(asctime)s %(module)s %(process)d %(thread)d %(message)s'
+
 LOGGING = {
     'version': 1,
     'formatters': {
-        'verbose': {'format': '%(levelname)s %(asctime)s %(module)s %(process)d %(thread)d %(message)s'},
         'simple': {'format': '%(levelname)s %(message)s'},
     },
     'handlers': {
-        'console': {'level': 'DEBUG', 'class': 'logging.StreamHandler', 'formatter': 'verbose'},
+        'queue': {'level': 'DEBUG' if DEBUG else 'INFO', 'class': 'logging.handlers.QueueHandler', 'queue': LOG_QUEUE},
     },
     'loggers': {
         'django': {
-            'handlers': ['console'],
+            'handlers': ['queue'],
             'level': 'INFO',
             'propagate': True,
         },